@@ -1,67 +1,174 @@
 import boto3
 import logging
+import math
+import os
+import random
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# --- AWS clients (built once per cold start, reused on warm invocations) ---
+REGION = 'ap-south-1'
+BOTO_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+EC2 = boto3.client('ec2', region_name=REGION, config=BOTO_CONFIG)
+DDB = boto3.client('dynamodb', region_name=REGION, config=BOTO_CONFIG)
+LOGS = boto3.client('logs', region_name=os.environ.get('AWS_REGION', REGION), config=BOTO_CONFIG)
+
+# Log group the instances stream auditd events to, one stream per /{instance_name}/{instance_id}
+AUDIT_LOG_GROUP = '/ec2/auditd'
+
+# Largest page DescribeInstances / DescribeTags will return
+EC2_PAGE_SIZE = 1000
+
+# Roughly one scan segment per 1000 items, capped to keep the worker pool small
+ITEMS_PER_SEGMENT = 1000
+MAX_SCAN_SEGMENTS = 16
+
+# BatchWriteItem accepts at most 25 requests; keep delete concurrency below the table's WCU
+BATCH_WRITE_SIZE = 25
+DELETE_WORKERS = 8
+MAX_BATCH_WRITE_ATTEMPTS = 8
+
+def scan_segment_keys(table_name, key_names, segment, total_segments):
+    # Project only the key attributes; aliases avoid clashes with reserved words
+    attr_names = {f"#k{i}": name for i, name in enumerate(key_names)}
+    paginator = DDB.get_paginator('scan')
+
+    keys = []
+    # The paginator keeps following LastEvaluatedKey (each page is capped at 1MB)
+    for page in paginator.paginate(
+        TableName=table_name,
+        Segment=segment,
+        TotalSegments=total_segments,
+        ProjectionExpression=", ".join(attr_names),
+        ExpressionAttributeNames=attr_names
+    ):
+        keys.extend(page.get('Items', []))
+
+    return keys
+
+def delete_key_chunk(table_name, keys):
+    request_items = {table_name: [{'DeleteRequest': {'Key': key}} for key in keys]}
+
+    for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+        response = DDB.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems', {})
+        if not request_items:
+            return len(keys)
+
+        # Throttled writes come back as UnprocessedItems; back off with jitter before resubmitting
+        if attempt < MAX_BATCH_WRITE_ATTEMPTS - 1:
+            time.sleep(2 ** attempt * 0.05 + random.random() * 0.05)
+
+    raise Exception(f"{len(request_items[table_name])} deletes still unprocessed after {MAX_BATCH_WRITE_ATTEMPTS} attempts")
+
 def clear_dynamodb_table(table_name):
-    dynamodb = boto3.resource('dynamodb', region_name='ap-south-1')
-    table = dynamodb.Table(table_name)
+    table_desc = DDB.describe_table(TableName=table_name)['Table']
     
     # 1. Get the Key Schema of the table dynamically
     # This tells us exactly what the Partition Key and Sort Key are named
-    key_names = [k['AttributeName'] for k in table.key_schema]
+    key_names = [k['AttributeName'] for k in table_desc['KeySchema']]
     logger.info(f"Table keys detected: {key_names}")
 
-    # 2. Scan the table
-    scan = table.scan()
-    items = scan.get('Items', [])
-    
-    if not items:
+    # 2. Size the parallel scan from the (approximate) item count
+    total_segments = min(max(math.ceil(table_desc.get('ItemCount', 0) / ITEMS_PER_SEGMENT), 1), MAX_SCAN_SEGMENTS)
+    logger.info(f"Scanning table with {total_segments} parallel scan segment(s).")
+
+    # 3. Collect the keys of every segment concurrently
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [
+            executor.submit(scan_segment_keys, table_name, key_names, segment, total_segments)
+            for segment in range(total_segments)
+        ]
+        keys = [key for f in futures for key in f.result()]
+
+    if not keys:
         logger.info("Table is already empty.")
         return
 
-    # 3. Delete items using the correct schema
-    with table.batch_writer() as batch:
-        for item in items:
-            # Create a key dictionary containing only the required Key attributes
-            key_to_delete = {k: item[k] for k in key_names}
-            batch.delete_item(Key=key_to_delete)
+    # 4. Delete the keys in 25-item batches across a bounded worker pool
+    key_iter = iter(keys)
+    chunks = iter(lambda: list(islice(key_iter, BATCH_WRITE_SIZE)), [])
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        deleted = sum(executor.map(lambda chunk: delete_key_chunk(table_name, chunk), chunks))
             
-    logger.info(f"Successfully deleted {len(items)} items.")
+    logger.info(f"Successfully deleted {deleted} items.")
+
+def index_log_stream_activity():
+    """
+    Lists every stream in AUDIT_LOG_GROUP once and returns {stream_name: lastEventTimestamp},
+    so the per-instance audits do not each call DescribeLogStreams (rate-limited to 5 TPS).
+    Returns an empty dict on failure; the audits then fall back to their own lookup.
+    """
+    stream_activity = {}
+    try:
+        paginator = LOGS.get_paginator('describe_log_streams')
+        for page in paginator.paginate(logGroupName=AUDIT_LOG_GROUP):
+            for stream in page.get('logStreams', []):
+                stream_activity[stream['logStreamName']] = stream.get('lastEventTimestamp')
+    except Exception as e:
+        logger.error(f"Failed to index CW Log streams: {str(e)}")
+        return {}
+
+    logger.info(f"Indexed {len(stream_activity)} log streams in {AUDIT_LOG_GROUP}.")
+    return stream_activity
+
+def index_instance_names():
+    """
+    Returns {instance_id: Name tag} for all instances, from one DescribeTags listing
+    filtered to the Name key, instead of scanning every instance's tag list.
+    """
+    paginator = EC2.get_paginator('describe_tags')
+    filters = [
+        {'Name': 'resource-type', 'Values': ['instance']},
+        {'Name': 'key', 'Values': ['Name']}
+    ]
+
+    name_by_id = {}
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': EC2_PAGE_SIZE}):
+        for tag in page['Tags']:
+            name_by_id[tag['ResourceId']] = tag['Value']
+
+    return name_by_id
 
 def lambda_handler(event, context):
     # 1. Clear the DynamoDB table first
     table_name = os.environ.get('DYNAMODB_TABLE_NAME')
     clear_dynamodb_table(table_name)
 
-    # 2. Proceed with listing running instances
-    ec2 = boto3.client('ec2', region_name='ap-south-1')
-    paginator = ec2.get_paginator('describe_instances')
+    # 2. Index the audit log streams once for all instances
+    stream_activity = index_log_stream_activity()
+
+    # 3. Proceed with listing running instances
+    name_by_id = index_instance_names()
+    paginator = EC2.get_paginator('describe_instances')
     
     filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
-    instances_to_check = []
+
+    # Parallel lists (one entry per instance) keep the Step Function payload small:
+    # each field name is stored once instead of once per instance
+    ids, names, last_events = [], [], []
     
-    page_iterator = paginator.paginate(Filters=filters)
+    page_iterator = paginator.paginate(Filters=filters, PaginationConfig={'PageSize': EC2_PAGE_SIZE})
     
     for page in page_iterator:
         for reservation in page['Reservations']:
             for ins in reservation['Instances']:
-                private_ip = ins.get('PrivateIpAddress')
-                if not private_ip:
-                    continue
-                
-                instance_name = "Unknown"
-                if 'Tags' in ins:
-                    instance_name = next((tag['Value'] for tag in ins['Tags'] if tag['Key'] == 'Name'), "Unknown")
+                instance_name = name_by_id.get(ins['InstanceId'], "Unknown")
                 
-                instances_to_check.append({
-                    "instance_id": ins['InstanceId'],
-                    "instance_ip": private_ip,
-                    "instance_name": instance_name,
-                    "key_pair_name": ins.get('KeyName'),
-                    "state": ins['State']['Name']
-                })
+                ids.append(ins['InstanceId'])
+                names.append(instance_name)
+                last_events.append(stream_activity.get(f"/{instance_name}/{ins['InstanceId']}"))
     
-    logger.info(f"Discovery complete. Found {len(instances_to_check)} running instances.")
-    return instances_to_check
\ No newline at end of file
+    logger.info(f"Discovery complete. Found {len(ids)} running instances.")
+    return {
+        "count": len(ids),
+        "instance_ids": ids,
+        "instance_names": names,
+        "last_event_timestamps": last_events
+    }
@@ -1,50 +1,115 @@
-import paramiko
-import io
 import boto3
 import logging
 import time
 import os
 from datetime import datetime
 from datetime import timedelta
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Services audited on every instance, and how long (seconds) SSM may take to deliver the probe
+# and then to run it on the instance (executionTimeout, otherwise the document default of 3600s)
+SERVICES = ["amazon-cloudwatch-agent", "auditd"]
+SSM_COMMAND_TIMEOUT = 30
+# How long to wait for a result: up to SSM_COMMAND_TIMEOUT for delivery plus up to executionTimeout to run
+SSM_POLL_DEADLINE = SSM_COMMAND_TIMEOUT * 2
+
+# Poll the command result quickly at first (a probe usually finishes in 1-2s), backing off to 2s
+SSM_POLL_INITIAL_DELAY = 0.5
+SSM_POLL_MAX_DELAY = 2
+
+# --- AWS clients (built once per cold start, reused on warm invocations) ---
+REGION = 'ap-south-1'
+BOTO_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+EC2 = boto3.client('ec2', region_name=REGION, config=BOTO_CONFIG)
+DDB = boto3.resource('dynamodb', region_name=REGION, config=BOTO_CONFIG)
+SSM = boto3.client('ssm', region_name=REGION, config=BOTO_CONFIG)
+LOGS = boto3.client('logs', region_name=os.environ.get('AWS_REGION', REGION), config=BOTO_CONFIG)
+
+def run_service_checks(instance_id):
+    """
+    Runs 'systemctl is-active' for SERVICES on the instance through SSM Run Command.
+    Returns a dict of service name -> 'active' / 'inactive'.
+    Raises if the command cannot be delivered or does not finish in time.
+    """
+    # 'systemctl is-active' is the standard for scripting: it prints one state per unit,
+    # in order, and returns exit code 0 only if every unit is active
+    response = SSM.send_command(
+        InstanceIds=[instance_id],
+        DocumentName='AWS-RunShellScript',
+        Parameters={
+            'commands': [f"systemctl is-active {' '.join(SERVICES)}"],
+            'executionTimeout': [str(SSM_COMMAND_TIMEOUT)]
+        },
+        # Delivery timeout only; the run time is bounded by executionTimeout above
+        TimeoutSeconds=SSM_COMMAND_TIMEOUT
+    )
+    command_id = response['Command']['CommandId']
+    logger.info(f"SSM command {command_id} sent to {instance_id}")
+
+    # Poll until the command reaches a final state
+    deadline = time.time() + SSM_POLL_DEADLINE
+    delay = SSM_POLL_INITIAL_DELAY
+    while True:
+        time.sleep(delay)
+        delay = min(delay * 1.5, SSM_POLL_MAX_DELAY)
+        try:
+            invocation = SSM.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+        except ClientError as e:
+            # The invocation may not be registered yet right after send_command
+            if e.response['Error']['Code'] != 'InvocationDoesNotExist':
+                raise
+            invocation = {'Status': 'Pending'}
+
+        status = invocation['Status']
+        if status not in ('Pending', 'InProgress', 'Delayed', 'Cancelling'):
+            break
+        if time.time() > deadline:
+            raise Exception(f"SSM command {command_id} still {status} after {SSM_POLL_DEADLINE}s")
+
+    # 'Failed' only means a non-zero exit code here, i.e. some service is not active
+    if status not in ('Success', 'Failed'):
+        raise Exception(f"SSM command {command_id} ended with status {status}")
+
+    exit_status = invocation.get('ResponseCode')
+    states = invocation.get('StandardOutputContent', '').split()
+    service_statuses = {}
+
+    for index, service in enumerate(SERVICES):
+        state = states[index] if index < len(states) else "unknown"
+
+        if exit_status == 0 or state == "active":
+            service_statuses[service] = "active"
+        else:
+            # If not found or inactive, we log as inactive
+            service_statuses[service] = "inactive"
+            logger.info(f"Service {service} on {instance_id} reported '{state}' (exit code {exit_status})")
+
+    return service_statuses
+
 def lambda_handler(event, context):
-    ec2 = boto3.client('ec2', region_name='ap-south-1')
-    dynamodb = boto3.resource('dynamodb', region_name='ap-south-1')
-    table = dynamodb.Table('InstanceAduditStatusChecksTBD')
+    table = DDB.Table('InstanceAduditStatusChecksTBD')
     
     # --- CONFIGURATION FROM STEP FUNCTION ---
     instance_id = event.get('instance_id')
-    instance_ip = event.get('instance_ip')
     instance_name = event.get('instance_name', 'Unknown')
-    key_pair_name = event.get('key_pair_name')
     
-    if not instance_id or not instance_ip:
-        raise Exception("Input missing instance_id or instance_ip")
+    if not instance_id:
+        raise Exception("Input missing instance_id")
     
-    temp_sg_id = None
-    original_sg_ids = []
     # timestamp = datetime.now().isoformat()
 
     now_utc = datetime.utcnow()
     now_ist = now_utc + timedelta(hours=5, minutes=30)
     timestamp = now_ist.strftime('%Y-%m-%d %H:%M:%S')
 
-    # 1. Get the Lambda's own Security Group dynamically
-    lambda_client = boto3.client('lambda')
-    try:
-        response = lambda_client.get_function_configuration(FunctionName=context.function_name)
-        lambda_sg_id = response['VpcConfig']['SecurityGroupIds'][0]
-    except (KeyError, IndexError):
-        logger.error("Lambda is not configured with a VPC.")
-        raise Exception("Lambda must be in a VPC to perform this task.")
-
     try:
-        # 2. Pre-flight check: Verify instance state
-        instance_desc = ec2.describe_instances(InstanceIds=[instance_id])
+        # 1. Pre-flight check: Verify instance state
+        instance_desc = EC2.describe_instances(InstanceIds=[instance_id])
         instance_data = instance_desc['Reservations'][0]['Instances'][0]
 
         current_state = instance_data['State']['Name']
@@ -58,136 +123,39 @@ def lambda_handler(event, context):
             })
             return {"statusCode": 200, "message": "Instance not running"}
 
-        vpc_id = instance_data['VpcId']
-        original_sg_ids = [sg['GroupId'] for sg in instance_data['SecurityGroups']]
-
-        # 3. JIT Networking Setup
-        sg_name = f"Temp-SSH-{instance_id}"
+        # --- SSM RUN COMMAND LOGIC (Protected Block) ---
         try:
-            sg_response = ec2.create_security_group(
-                GroupName=sg_name, Description=f"JIT Access for {instance_name}", VpcId=vpc_id
-            )
-            temp_sg_id = sg_response['GroupId']
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'InvalidGroup.Duplicate':
-                existing = ec2.describe_security_groups(Filters=[{'Name': 'group-name', 'Values': [sg_name]}])
-                temp_sg_id = existing['SecurityGroups'][0]['GroupId']
-            else:
-                raise e
-
-        ec2.authorize_security_group_ingress(
-            GroupId=temp_sg_id,
-            IpPermissions=[{'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22,
-                            'UserIdGroupPairs': [{'GroupId': lambda_sg_id}]}]
-        )
-
-        ec2.modify_instance_attribute(InstanceId=instance_id, Groups=original_sg_ids + [temp_sg_id])
-        logger.info(f"SG {temp_sg_id} attached. Waiting 15s...")
-        time.sleep(15)
-
-        # --- SSH AND SECRET LOGIC (Protected Block) ---
-        try:
-            if not key_pair_name:
-                raise ValueError("No KeyPair associated with this instance")
-
-            # Fetch Secret with proper error mapping
-            s_client = boto3.client('secretsmanager', region_name='ap-south-1')
-            try:
-                secret_response = s_client.get_secret_value(SecretId=key_pair_name)
-                secret_string = secret_response['SecretString']
-            except ClientError as e:
-                err_code = e.response['Error']['Code']
-                if err_code == 'ResourceNotFoundException':
-                    raise Exception(f"Secret '{key_pair_name}' missing in Secrets Manager")
-                elif err_code == 'AccessDeniedException':
-                    raise Exception(f"Lambda IAM role denied access to secret '{key_pair_name}'")
-                else:
-                    raise Exception(f"SecretsManager Error: {err_code}")
-
-            # Connect SSH
-
-            # ... (Secret fetching code remains the same) ...
-
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            pkey = paramiko.RSAKey.from_private_key(io.StringIO(secret_string))
-            
-            # List of common AWS usernames to try
-            usernames = ["ubuntu", "ec2-user"]
-            connected = False
-            last_error = ""
-
-            for user in usernames:
-                try:
-                    logger.info(f"Attempting SSH as {user} for {instance_ip}...")
-                    ssh_client.connect(
-                        hostname=instance_ip, 
-                        username=user, 
-                        pkey=pkey, 
-                        timeout=10,
-                        allow_agent=False,
-                        look_for_keys=False
-                    )
-                    connected = True
-                    logger.info(f"Successfully connected as {user}")
-                    break
-                except paramiko.AuthenticationException:
-                    last_error = f"Auth failed for {user}"
-                    continue
-                except Exception as e:
-                    last_error = str(e)
-                    continue
-
-            if not connected:
-                raise Exception(f"Could not connect with any known username. Last error: {last_error}")
-
-            time.sleep(2) 
-
-            # Run Checks (Uses Exit Codes for 100% accuracy)
-            services = ["amazon-cloudwatch-agent", "auditd"]
-            service_statuses = {}
-            
-            for service in services:
-                # 'systemctl is-active' is the standard for scripting
-                # It returns exit code 0 if active, and non-zero if inactive or missing
-                stdin, stdout, stderr = ssh_client.exec_command(f"systemctl is-active {service}")
-                
-                # We check the exit status rather than searching the text string
-                exit_status = stdout.channel.recv_exit_status()
-                
-                if exit_status == 0:
-                    service_statuses[service] = "active"
-                else:
-                    # If not found or inactive, we log as inactive
-                    service_statuses[service] = "inactive"
-                    logger.info(f"Service {service} on {instance_id} returned exit code {exit_status}")
-            
-            ssh_client.close()
+            # 2. Run Checks through the SSM agent (Uses Exit Codes for 100% accuracy)
+            service_statuses = run_service_checks(instance_id)
 
             # --- NEW FEATURE: CloudWatch Log Verification (Dynamic & 10hr Window) ---
             audit_streaming = "NO"
             try:
-                # 1. Use dynamic Region and Log Group
-                current_region = os.environ.get('AWS_REGION', 'ap-south-1')
-                logs_client = boto3.client('logs', region_name=current_region)
-                
-                # 2. Construct Dynamic Stream Name based on Instance Name and ID
+                # 1. Construct Dynamic Stream Name based on Instance Name and ID
                 # Format: /{instance_name}/{instance_id}
                 stream_prefix = f"/{instance_name}/{instance_id}"
                 
-                logger.info(f"Checking CloudWatch Logs for stream: {stream_prefix}")
-                
-                log_response = logs_client.describe_log_streams(
-                    logGroupName='/ec2/auditd',
-                    logStreamNamePrefix=stream_prefix,
-                    limit=1
-                )
-                
-                if log_response.get('logStreams'):
-                    # Pick the specific stream that matches exactly
-                    stream = log_response['logStreams'][0]
-                    last_event = stream.get('lastEventTimestamp')
+                # Function1 passes the stream's lastEventTimestamp from a single listing of the
+                # log group; only look the stream up here when it was not indexed there
+                last_event = event.get('last_event_timestamp')
+                stream_found = last_event is not None
+
+                if not stream_found:
+                    logger.info(f"Checking CloudWatch Logs for stream: {stream_prefix}")
+                    
+                    log_response = LOGS.describe_log_streams(
+                        logGroupName='/ec2/auditd',
+                        logStreamNamePrefix=stream_prefix,
+                        limit=1
+                    )
                     
+                    if log_response.get('logStreams'):
+                        # Pick the specific stream that matches exactly
+                        stream = log_response['logStreams'][0]
+                        last_event = stream.get('lastEventTimestamp')
+                        stream_found = True
+                
+                if stream_found:
                     if last_event:
                         # Convert 10 hours to milliseconds
                         current_time_ms = int(time.time() * 1000)
@@ -224,7 +192,7 @@ def lambda_handler(event, context):
             return {"statusCode": 200, "data": item}
 
         except Exception as inner_err:
-            # Catch SSH/Secret errors, log them, but don't crash (keep cleanup running)
+            # Catch SSM errors, log them, but don't crash
             logger.error(f"Audit failed for {instance_id}: {str(inner_err)}")
             table.put_item(Item={
                 'InstanceId': instance_id,
@@ -237,14 +205,3 @@ def lambda_handler(event, context):
     except Exception as e:
         logger.error(f"Critical System Error: {str(e)}")
         raise e
-
-    finally:
-        # Ensure cleanup happens even if SSH fails
-        if temp_sg_id:
-            try:
-                logger.info(f"Detaching and deleting SG {temp_sg_id}")
-                ec2.modify_instance_attribute(InstanceId=instance_id, Groups=original_sg_ids)
-                time.sleep(2)
-                ec2.delete_security_group(GroupId=temp_sg_id)
-            except Exception as cleanup_err:
-                logger.error(f"Cleanup failed: {str(cleanup_err)}")
\ No newline at end of file
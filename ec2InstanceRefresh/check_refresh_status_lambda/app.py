@@ -1,86 +1,137 @@
 import boto3
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import os
 
 # --- Configuration for DynamoDB ---
 DYNAMODB_TABLE_NAME = os.environ.get('ASG_REFRESH_MONITOR_TABLE', 'ASG_Refresh_Monitor_TBD')
-dynamodb_resource = boto3.resource('dynamodb')
-monitor_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+dynamodb_client = boto3.client('dynamodb')
 
 autoscaling_client = boto3.client('autoscaling')
 
-def lambda_handler(event, context):
-    asg_name = event["asg_name"]
-    refresh_id = event["refresh_id"]
-    
-    # Get the current iteration count from the Step Function's state input
-    # The Step Function ensures this is passed from the $.status_check_counter
-    current_iteration_count = event.get('status_check_counter', {}).get('check_count', 0)
-    
-    # Increment the count for logging/display purposes (since the Step Function increments AFTER the wait)
-    db_iteration_count = current_iteration_count + 1 
-    
-    # 1. Check ASG Refresh Status
+# Statuses after which an ASG is no longer polled
+FINAL_STATUSES = {"Successful", "Failed", "Cancelled", "TIMEOUT_FAILED"}
+
+def describe_refresh_status(asg_name, refresh_id):
+    """
+    Returns the instance refresh status, or the exception raised while describing it.
+    EC2 Auto Scaling cannot describe refreshes of several ASGs in one call, so this runs once per ASG.
+    """
     try:
         resp = autoscaling_client.describe_instance_refreshes(
             AutoScalingGroupName=asg_name,
             InstanceRefreshIds=[refresh_id]
         )
-        
         # Status can be 'Pending', 'InProgress', 'Successful', 'Failed', 'Cancelled'
-        instance_refresh_status = resp["InstanceRefreshes"][0]["Status"]
-        status_message = f"ASG refresh status: {instance_refresh_status}"
-        
-        # 2. Update DynamoDB Record
-        monitor_table.update_item(
-            Key={'asg_name': asg_name},
-            UpdateExpression="SET current_status = :s, iteration_count = :i, last_update_time = :l, last_message = :m",
-            ExpressionAttributeValues={
-                ':s': instance_refresh_status,
-                ':i': db_iteration_count,
-                ':l': datetime.now().isoformat(),
-                ':m': status_message
-            }
-        )
+        return resp["InstanceRefreshes"][0]["Status"]
+    except Exception as e:
+        return e
+
+def update_monitor_record(asg_name, status, iteration_count, message, now_iso):
+    """
+    Writes one ASG's status through the low-level client, with the attribute values pre-built.
+    """
+    dynamodb_client.update_item(
+        TableName=DYNAMODB_TABLE_NAME,
+        Key={'asg_name': {'S': asg_name}},
+        UpdateExpression="SET current_status = :s, iteration_count = :i, last_update_time = :l, last_message = :m",
+        ExpressionAttributeValues={
+            ':s': {'S': status},
+            ':i': {'N': str(iteration_count)},
+            ':l': {'S': now_iso},
+            ':m': {'S': message}
+        }
+    )
 
-        # 3. Check for Step Function enforced timeout (45 checks = 45 minutes)
-        max_checks = event.get('status_check_counter', {}).get('max_checks', 45)
+def record_status(asg_name, instance_refresh_status, previous_status, db_iteration_count, max_checks, now_iso):
+    """
+    Writes the latest status of one ASG to DynamoDB and returns the status to report for it.
+    If the status could not be read, previous_status is reported so the ASG is polled again.
+    """
+    try:
+        if isinstance(instance_refresh_status, Exception):
+            raise instance_refresh_status
 
+        # 1. Check for Step Function enforced timeout (45 checks = 45 minutes)
         if instance_refresh_status in ["Pending", "InProgress"] and db_iteration_count >= max_checks:
-            # We are hitting the max iteration count, force a 'TIMEOUT_FAILED' status update
-            timeout_message = f"Instance Refresh timed out after {max_checks} minutes."
-            
-            monitor_table.update_item(
-                Key={'asg_name': asg_name},
-                UpdateExpression="SET current_status = :s, last_update_time = :l, last_message = :m",
-                ExpressionAttributeValues={
-                    ':s': 'TIMEOUT_FAILED',
-                    ':l': datetime.now().isoformat(),
-                    ':m': timeout_message
-                }
-            )
-            # The Step Function's "CheckCounter" state will catch this, but we update the DB here.
-            # We let the Step Function flow handle the failure state via 'MarkTimeoutFailure'.
+            # We are hitting the max iteration count, record 'TIMEOUT_FAILED' instead of the live status
+            final_status = 'TIMEOUT_FAILED'
+            status_message = f"Instance Refresh timed out after {max_checks} minutes."
+        else:
+            final_status = instance_refresh_status
+            status_message = f"ASG refresh status: {instance_refresh_status}"
 
-        # 4. Return status for Step Function Choice state (EvaluateStatus)
-        return {
-            "status": instance_refresh_status,
-            "asg_name": asg_name
-        }
+        # 2. Update DynamoDB Record
+        update_monitor_record(asg_name, final_status, db_iteration_count, status_message, now_iso)
+        return final_status
 
     except Exception as e:
         error_message = f"Error in check_refresh_status_lambda_TBD for {asg_name}: {str(e)}"
         print(error_message)
         
+        # Out of checks: the refresh may still be running, but the batch can no longer wait for it
+        if db_iteration_count >= max_checks:
+            update_monitor_record(asg_name, 'TIMEOUT_FAILED', db_iteration_count, error_message, now_iso)
+            return 'TIMEOUT_FAILED'
+
         # Ensure a record is written even on a critical failure during checks
-        monitor_table.update_item(
-            Key={'asg_name': asg_name},
-            UpdateExpression="SET current_status = :s, iteration_count = :i, last_update_time = :l, last_message = :m",
-            ExpressionAttributeValues={
-                ':s': 'CHECK_ERROR',
-                ':i': db_iteration_count,
-                ':l': datetime.now().isoformat(),
-                ':m': error_message
-            }
-        )
-        raise # Re-raise the exception for the Step Function to handle
\ No newline at end of file
+        update_monitor_record(asg_name, 'CHECK_ERROR', db_iteration_count, error_message, now_iso)
+        # The error may be transient (e.g. throttling) and the refresh may still be running:
+        # keep the ASG in progress so the next check polls it again
+        return previous_status or 'InProgress'
+
+def lambda_handler(event, context):
+    # The batch's StartRefresh results: [{"asg_name": ..., "skip": ..., "refresh_id": ...}, ...]
+    # ASGs that were skipped or failed to start have no refresh to poll
+    start_results = event.get("refreshes", [])
+    refreshes = [r for r in start_results if not r.get("skip") and r.get("refresh_id")]
+
+    # StartRefresh failures carry the caught error (see MarkStartFailure) and fail the batch
+    start_failures = [r["asg_name"] for r in start_results if "error" in r]
+
+    # Statuses from the previous check; ASGs that already finished are not polled again
+    statuses = event.get("refresh_status_check", {}).get("statuses", {})
+    pending = [r for r in refreshes if statuses.get(r["asg_name"]) not in FINAL_STATUSES]
+    
+    # Get the current iteration count from the Step Function's state input
+    # The Step Function ensures this is passed from the $.status_check_counter
+    current_iteration_count = event.get('status_check_counter', {}).get('check_count', 0)
+    max_checks = event.get('status_check_counter', {}).get('max_checks', 45)
+    
+    # Increment the count for logging/display purposes (since the Step Function increments AFTER the wait)
+    db_iteration_count = current_iteration_count + 1 
+
+    if pending:
+        # One UTC timestamp for every record written by this check
+        now_iso = datetime.now(timezone.utc).isoformat()
+
+        # 1. Check every ASG Refresh Status concurrently
+        with ThreadPoolExecutor(max_workers=min(len(pending), 10)) as executor:
+            results = list(executor.map(
+                lambda r: describe_refresh_status(r["asg_name"], r["refresh_id"]), pending
+            ))
+
+        # 2. Record the results in DynamoDB
+        for refresh, instance_refresh_status in zip(pending, results):
+            asg_name = refresh["asg_name"]
+            statuses[asg_name] = record_status(
+                asg_name, instance_refresh_status, statuses.get(asg_name), db_iteration_count, max_checks, now_iso
+            )
+
+    in_progress = [asg for asg, status in statuses.items() if status not in FINAL_STATUSES]
+    print(f"Check {db_iteration_count}: {len(in_progress)} of {len(statuses)} ASG refreshes still in progress.")
+
+    # 3. Return the batch status for the Step Function Choice state (EvaluateStatus)
+    if in_progress:
+        batch_status = "InProgress"
+        failed_asgs = []
+    else:
+        # Anything that did not finish 'Successful' (Failed, Cancelled, TIMEOUT_FAILED) fails the batch
+        failed_asgs = start_failures + [asg for asg, status in statuses.items() if status != "Successful"]
+        batch_status = "CompleteWithFailures" if failed_asgs else "Complete"
+
+    return {
+        "status": batch_status,
+        "statuses": statuses,
+        "failed_asgs": failed_asgs
+    }
@@ -1,9 +1,48 @@
 import boto3
 import yaml 
 import os 
+from botocore.exceptions import ClientError
 
 s3_client = boto3.client('s3')
 
+# libyaml's C loader parses far faster than the pure-Python one; PyYAML wheels bundle it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed service mapping kept across warm invocations, keyed by the S3 object's ETag
+_CACHE = {'etag': None, 'data': None}
+
+def load_service_mapping(bucket_name, key_name):
+    """
+    Returns the parsed YAML from S3, re-downloading and re-parsing it only when its ETag changes.
+    Raises ClientError if the object cannot be read and yaml.YAMLError if it cannot be parsed.
+    """
+    get_kwargs = {'Bucket': bucket_name, 'Key': key_name}
+    if _CACHE['etag']:
+        # S3 answers 304 Not Modified (without a body) if the object is unchanged
+        get_kwargs['IfNoneMatch'] = _CACHE['etag']
+
+    try:
+        s3_object = s3_client.get_object(**get_kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            print(f"Using cached s3://{bucket_name}/{key_name} (ETag {_CACHE['etag']})")
+            return _CACHE['data']
+        raise
+
+    yaml_content = s3_object['Body'].read().decode('utf-8')
+    data = yaml.load(yaml_content, Loader=YAML_LOADER)
+
+    _CACHE['etag'] = s3_object['ETag']
+    _CACHE['data'] = data
+    return data
+
+def is_enabled(env_value):
+    """
+    True if the environment flag is explicitly set to True.
+    YAML already yields a bool for unquoted True; quoted values arrive as strings.
+    """
+    return env_value is True or (isinstance(env_value, str) and env_value.strip() == 'True')
+
 def lambda_handler(event, context):
     
     # -----------------------------------------------------------
@@ -27,54 +66,41 @@ def lambda_handler(event, context):
         print("WARNING: BATCH_SIZE environment variable is not a valid integer. Defaulting to 10.")
         batch_size = 10
     
-    # 2. Read the YAML file from S3
+    # 2. Read and parse the YAML file from S3 (served from the warm cache when unchanged)
     try:
         print(f"Attempting to read s3://{BUCKET_NAME}/{KEY_NAME}")
-        s3_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=KEY_NAME)
-        yaml_content = s3_object['Body'].read().decode('utf-8')
-    except Exception as e:
-        print(f"ERROR: Could not read S3 file. {e}")
+        data = load_service_mapping(BUCKET_NAME, KEY_NAME)
+    except yaml.YAMLError as e:
+        # 3. The YAML content could not be parsed
+        print(f"ERROR: Could not parse YAML content. {e}")
         return {
             "total_asgs": 0,
             "batch_size": batch_size,
             "asg_batches": [],
-            "error_detail": f"Failed to read S3 file: {str(e)}"
+            "error_detail": "YAML Parsing Error"
         }
-
-    # 3. Parse the YAML content
-    try:
-        data = yaml.safe_load(yaml_content)
-    except yaml.YAMLError as e:
-        print(f"ERROR: Could not parse YAML content. {e}")
+    except Exception as e:
+        print(f"ERROR: Could not read S3 file. {e}")
         return {
             "total_asgs": 0,
             "batch_size": batch_size,
             "asg_batches": [],
-            "error_detail": "YAML Parsing Error"
+            "error_detail": f"Failed to read S3 file: {str(e)}"
         }
 
-    asgs_to_refresh = []
-    
     # Logging the target key for clarity in CloudWatch logs
     print(f"Targeting services where key '{TARGET_ENV_KEY}' is set to 'True'.")
 
     # 4. Iterate, Filter, and Construct ASG Names
     service_deployment = data.get('ServiceDeployment', {})
     
-    for service_name, environments in service_deployment.items():
-        # environments is expected to be a dict like {'dev': 'False', 'qa': 'True', ...}
-        
-        if isinstance(environments, dict):
-            
-            # --- THE KEY CHANGE: Use the generic variable for lookup ---
-            env_value_to_check = environments.get(TARGET_ENV_KEY)
-            
-            # Check if the value is present and is explicitly set to 'True'
-            if env_value_to_check is not None and str(env_value_to_check).strip() == 'True':
-                
-                # Construct the ASG name with the suffix
-                asg_name = f"{service_name}{ASG_SUFFIX}"
-                asgs_to_refresh.append(asg_name)
+    # environments is expected to be a dict like {'dev': 'False', 'qa': 'True', ...}
+    # Construct the ASG name with the suffix for every service enabled in the target environment
+    asgs_to_refresh = [
+        f"{service_name}{ASG_SUFFIX}"
+        for service_name, environments in service_deployment.items()
+        if isinstance(environments, dict) and is_enabled(environments.get(TARGET_ENV_KEY))
+    ]
 
     # 5. Define batch size and create batches
     
@@ -1,56 +1,95 @@
 import boto3
-from datetime import datetime
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 import os
 
 # --- Configuration for DynamoDB ---
 DYNAMODB_TABLE_NAME = os.environ.get('ASG_REFRESH_MONITOR_TABLE')
-dynamodb_resource = boto3.resource('dynamodb')
-monitor_table = dynamodb_resource.Table(DYNAMODB_TABLE_NAME)
+dynamodb_client = boto3.client('dynamodb')
+
+# Target groups are checked concurrently, at most this many at a time
+MAX_HEALTH_CHECK_WORKERS = 10
 
 autoscaling_client = boto3.client('autoscaling')
-elb_client = boto3.client('elbv2') # Client for Elastic Load Balancing v2 (for Target Groups)
+# Client for Elastic Load Balancing v2 (for Target Groups), with a connection per health check worker
+elb_client = boto3.client('elbv2', config=Config(max_pool_connections=MAX_HEALTH_CHECK_WORKERS + 1))
+
+def record_refresh_status(asg_name, status, message, now_iso, refresh_id='N/A'):
+    """
+    Starts a new monitor record for this rotation run with a single UpdateItem.
+    Every run-scoped attribute is reset; attributes written by other tools are left untouched.
+    """
+    dynamodb_client.update_item(
+        TableName=DYNAMODB_TABLE_NAME,
+        Key={'asg_name': {'S': asg_name}},
+        UpdateExpression="SET current_status = :s, start_time = :l, last_update_time = :l, refresh_id = :r, iteration_count = :z, last_message = :m",
+        ExpressionAttributeValues={
+            ':s': {'S': status},
+            ':l': {'S': now_iso},
+            ':r': {'S': refresh_id},
+            ':z': {'N': '0'},
+            ':m': {'S': message}
+        }
+    )
+
+def check_single_target_group(tg_arn):
+    """
+    Checks one target group. Returns (True, None) if it has targets and all are healthy,
+    otherwise (False, reason).
+    """
+    # Get the health status of all registered instances
+    health_resp = elb_client.describe_target_health(
+        TargetGroupArn=tg_arn
+    )
+    
+    targets = health_resp.get("TargetHealthDescriptions", [])
+
+    # --- CHECK: ENSURE TARGET GROUP IS NOT EMPTY ---
+    if not targets:
+        return False, f"Target Group {tg_arn} found with ZERO registered targets. Skipping refresh."
+    
+    # Check health for each target in the group
+    for target_health in targets:
+        health_status = target_health["TargetHealth"]["State"]
+        
+        if health_status != "healthy":
+            # We found at least one unhealthy target
+            print(f"Target Group {tg_arn} has an UNHEALTHY target: {health_status} for instance {target_health['Target']['Id']}")
+            return False, f"Unhealthy target found in {tg_arn} (Status: {health_status})"
 
-def check_target_group_health(asg_name):
+    return True, None
+
+def check_target_group_health(asg_info):
     """
     Checks if all registered targets for the ASG's associated target groups are healthy.
+    asg_info is the ASG description already fetched by the handler.
     Returns True if all targets are healthy AND the count of targets is greater than zero.
     Returns False if:
         1. Any target group has at least one UNHEALTHY instance.
         2. Any associated target group has ZERO registered targets.
     """
     
-    # 1. Describe the ASG to get associated Target Group ARNs
-    asg_info = autoscaling_client.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[asg_name]
-    )["AutoScalingGroups"][0]
-    
+    # 1. Get the associated Target Group ARNs from the ASG description
     target_group_arns = asg_info.get("TargetGroupARNs", [])
     
     # If the ASG is not attached to any target group, assume health is not a block.
     if not target_group_arns:
         return True, "No associated target groups found. Proceeding."
 
-    # 2. Iterate through each associated Target Group
-    for tg_arn in target_group_arns:
-        # Get the health status of all registered instances
-        health_resp = elb_client.describe_target_health(
-            TargetGroupArn=tg_arn
-        )
-        
-        targets = health_resp.get("TargetHealthDescriptions", [])
+    # 2. Check every associated Target Group concurrently
+    # Not a 'with' block: its exit would join every in-flight check before an early return
+    executor = ThreadPoolExecutor(max_workers=min(len(target_group_arns), MAX_HEALTH_CHECK_WORKERS))
+    try:
+        futures = [executor.submit(check_single_target_group, tg_arn) for tg_arn in target_group_arns]
 
-        # --- CHECK: ENSURE TARGET GROUP IS NOT EMPTY ---
-        if not targets:
-            return False, f"Target Group {tg_arn} found with ZERO registered targets. Skipping refresh."
-        
-        # 3. Check health for each target in the group
-        for target_health in targets:
-            health_status = target_health["TargetHealth"]["State"]
-            
-            if health_status != "healthy":
-                # We found at least one unhealthy target
-                print(f"Target Group {tg_arn} has an UNHEALTHY target: {health_status} for instance {target_health['Target']['Id']}")
-                return False, f"Unhealthy target found in {tg_arn} (Status: {health_status})"
+        # 3. Stop at the first target group that blocks the refresh, without waiting for the rest
+        for future in as_completed(futures):
+            is_healthy, health_message = future.result()
+            if not is_healthy:
+                return False, health_message
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
     # If the loop finishes after successfully checking targets and finding at least one target in each TG.
     return True, "All registered targets across all associated target groups are present and healthy."
@@ -58,6 +97,9 @@ def check_target_group_health(asg_name):
 
 def lambda_handler(event, context):
     asg_name = event["asg_name"]
+
+    # One UTC timestamp for every record written by this invocation
+    now_iso = datetime.now(timezone.utc).isoformat()
     
     # --- 1. Initial DynamoDB Record Setup ---
     # We write a record immediately with a preliminary status
@@ -77,17 +119,7 @@ def lambda_handler(event, context):
             print(message)
             initial_status = "SKIPPED_CAPACITY_ZERO"
             
-            monitor_table.put_item(
-                Item={
-                    'asg_name': asg_name,
-                    'current_status': initial_status,
-                    'start_time': datetime.now().isoformat(),
-                    'last_update_time': datetime.now().isoformat(),
-                    'refresh_id': 'N/A',
-                    'iteration_count': 0,
-                    'last_message': message
-                }
-            )
+            record_refresh_status(asg_name, initial_status, message, now_iso)
             return {
                 "asg_name": asg_name,
                 "skip": True,
@@ -95,24 +127,14 @@ def lambda_handler(event, context):
             }
 
         # --- 3. Check for Target Group Health (and Target Count) ---
-        is_healthy, health_message = check_target_group_health(asg_name)
+        is_healthy, health_message = check_target_group_health(asg_info)
 
         if not is_healthy:
             message = f"Skipped {asg_name}: Target Health Check Failed ({health_message})."
             print(message)
             initial_status = "SKIPPED_UNHEALTHY"
             
-            monitor_table.put_item(
-                Item={
-                    'asg_name': asg_name,
-                    'current_status': initial_status,
-                    'start_time': datetime.now().isoformat(),
-                    'last_update_time': datetime.now().isoformat(),
-                    'refresh_id': 'N/A',
-                    'iteration_count': 0,
-                    'last_message': message
-                }
-            )
+            record_refresh_status(asg_name, initial_status, message, now_iso)
             return {
                 "asg_name": asg_name,
                 "skip": True,
@@ -137,17 +159,7 @@ def lambda_handler(event, context):
         
         # --- 5. Record Start of Refresh in DynamoDB ---
         initial_status = "REFRESH_STARTED"
-        monitor_table.put_item(
-            Item={
-                'asg_name': asg_name,
-                'current_status': initial_status,
-                'start_time': datetime.now().isoformat(),
-                'last_update_time': datetime.now().isoformat(),
-                'refresh_id': refresh_id,
-                'iteration_count': 0,
-                'last_message': message
-            }
-        )
+        record_refresh_status(asg_name, initial_status, message, now_iso, refresh_id=refresh_id)
         
         return {
             "asg_name": asg_name,
@@ -161,15 +173,5 @@ def lambda_handler(event, context):
         print(error_message)
         
         # Ensure a record is written even on a critical failure
-        monitor_table.put_item(
-            Item={
-                'asg_name': asg_name,
-                'current_status': 'CRITICAL_ERROR',
-                'start_time': datetime.now().isoformat(),
-                'last_update_time': datetime.now().isoformat(),
-                'refresh_id': 'N/A',
-                'iteration_count': 0,
-                'last_message': error_message
-            }
-        )
+        record_refresh_status(asg_name, 'CRITICAL_ERROR', error_message, now_iso)
         raise # Re-raise the exception to be caught by the Step Function's Catch block
\ No newline at end of file